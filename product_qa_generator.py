@@ -1,6 +1,7 @@
 import pandas as pd
 from transformers import T5ForConditionalGeneration, T5Tokenizer
 from transformers import pipeline
+from transformers import StoppingCriteria, StoppingCriteriaList
 import torch
 import nltk
 from nltk.tokenize import sent_tokenize
@@ -10,8 +11,32 @@ from tqdm import tqdm
 # Download required NLTK data
 nltk.download('punkt')
 
+class QuestionMarkStoppingCriteria(StoppingCriteria):
+    """Stop each sequence in a batch as soon as it emits a token ending in '?'."""
+
+    def __init__(self, tokenizer, device):
+        # Collect every vocabulary token that ends a question (e.g. '?' and '▁?')
+        stop_ids = [
+            token_id for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(range(len(tokenizer))))
+            if token is not None and token.rstrip().endswith('?')
+        ]
+        self.stop_ids = torch.tensor(stop_ids, dtype=torch.long, device=device)
+
+    def __call__(self, input_ids, scores, **kwargs):
+        # Per-sequence flags: generate() pads finished rows and ends once every row is done.
+        # Broadcast compare rather than torch.isin, which has no MPS kernel before torch 2.4
+        return (input_ids[:, -1:] == self.stop_ids).any(dim=-1)
+
+
 class ProductQAGenerator:
-    def __init__(self):
+    # Decode budgets (new tokens) per task; override via the max_new_tokens argument
+    DEFAULT_MAX_NEW_TOKENS = {
+        "feature_questions": 64,
+        "review_questions": 64,
+        "summary": 130
+    }
+
+    def __init__(self, max_new_tokens=None):
         # Check if MPS (Metal Performance Shaders) is available for M1/M2
         device = torch.device('mps' if torch.backends.mps.is_available() else 'cpu')
         
@@ -41,6 +66,21 @@ class ProductQAGenerator:
         # Set device
         self.device = device
         self.question_model.to(self.device)
+        
+        # Per-task token budgets and question-aware stopping
+        max_new_tokens = max_new_tokens or {}
+        for task, budget in max_new_tokens.items():
+            if task not in self.DEFAULT_MAX_NEW_TOKENS:
+                raise ValueError(
+                    f"Unknown max_new_tokens task '{task}'. "
+                    f"Expected one of: {', '.join(self.DEFAULT_MAX_NEW_TOKENS)}"
+                )
+            if isinstance(budget, bool) or not isinstance(budget, int) or budget <= 0:
+                raise ValueError(f"max_new_tokens['{task}'] must be a positive int, got {budget!r}")
+        self.max_new_tokens = {**self.DEFAULT_MAX_NEW_TOKENS, **max_new_tokens}
+        self.question_stopping_criteria = StoppingCriteriaList([
+            QuestionMarkStoppingCriteria(self.question_tokenizer, self.device)
+        ])
 
     def generate_questions(self, context, num_questions=3, context_type="product"):
         """Generate questions from given context."""
@@ -57,33 +97,34 @@ class ProductQAGenerator:
         }
         
         questions = []
-        current_prompts = prompts.get(context_type, prompts["product"])
-        
-        # Generate one question per prompt
-        for prompt in current_prompts[:num_questions]:
-            # Tokenize input with explicit max_length
-            inputs = self.question_tokenizer.encode(
-                prompt,
-                return_tensors="pt",
-                max_length=1024,
-                truncation=True,
-                padding='max_length'
-            ).to(self.device)
-            
-            # Generate question with sampling enabled
-            outputs = self.question_model.generate(
-                inputs,
-                max_length=64,
-                num_return_sequences=1,
-                do_sample=True,
-                temperature=0.7,
-                top_k=50,
-                top_p=0.95,
-                no_repeat_ngram_size=2
-            )
-            
-            question = self.question_tokenizer.decode(outputs[0], skip_special_tokens=True)
-            
+        current_prompts = prompts.get(context_type, prompts["product"])[:num_questions]
+        if not current_prompts:
+            return questions
+        budget_key = "review_questions" if context_type == "review" else "feature_questions"
+        
+        # Tokenize all prompts as one batch, padded to the longest prompt
+        inputs = self.question_tokenizer(
+            current_prompts,
+            return_tensors="pt",
+            max_length=1024,
+            truncation=True,
+            padding='longest'
+        ).to(self.device)
+        
+        # Generate one question per prompt; each sequence stops at its first '?'
+        outputs = self.question_model.generate(
+            **inputs,
+            max_new_tokens=self.max_new_tokens[budget_key],
+            stopping_criteria=self.question_stopping_criteria,
+            num_return_sequences=1,
+            do_sample=True,
+            temperature=0.7,
+            top_k=50,
+            top_p=0.95,
+            no_repeat_ngram_size=2
+        )
+        
+        for question in self.question_tokenizer.batch_decode(outputs, skip_special_tokens=True):
             # Clean up the generated question
             question = question.strip()
             if not question.endswith('?'):
@@ -129,14 +170,16 @@ class ProductQAGenerator:
         if word_count < 30:
             return combined_reviews
             
-        # Adjust max_length based on input length, but keep it reasonable
-        max_length = min(130, max(30, word_count // 2))
-        min_length = min(30, max(10, word_count // 4))
+        # Size the decode budget from the model's own token count, capped per task
+        token_count = len(self.summarizer.tokenizer(combined_reviews, truncation=True)['input_ids'])
+        max_new_tokens = min(self.max_new_tokens["summary"], max(30, token_count // 2))
+        min_length = min(30, max(10, token_count // 4), max_new_tokens)
             
-        # Generate summary
+        # Generate summary; BART's max_length counts the decoder start token, so
+        # max_new_tokens + 1 is the budget the pipeline checks against the input length
         try:
             summary = self.summarizer(combined_reviews, 
-                                    max_length=max_length, 
+                                    max_length=max_new_tokens + 1, 
                                     min_length=min_length, 
                                     do_sample=False)[0]['summary_text']
             return summary